@@ -12,6 +12,7 @@ dotenv.load_dotenv(".env")
 
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import wandb
 import numpy as np
 import pandas as pd
@@ -39,6 +40,31 @@ DATA_PATH = os.environ.get("DATA_PATH")
 
 keep_insertions = True
 
+
+def load_pdb_file(filename):
+    """
+    Run `pdb_to_tensor_2` on a raw PDB file in a worker process.
+
+    Errors are returned instead of raised, so that they are reported per 
+    structure by the main process. Coordinates are returned as numpy arrays,
+    as torch would otherwise pass each tensor through its own shared memory
+    file descriptor.
+    """
+    try:
+        output = pdb_to_tensor_2(
+            os.path.join(DATA_PATH, "raw", filename),
+        #    os.path.join(DATA_PATH, "fr3d", structure_id + "_basepair.txt"),
+            keep_insertions=keep_insertions,
+            keep_pseudoknots=False,
+            use_cache=True
+        )
+    except Exception as e:
+        # not every exception can be pickled back to the main process
+        return None, RuntimeError(str(e))
+    if output is not None:
+        output = (output[0], output[1].numpy(), *output[2:])
+    return output, None
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--project_name', dest='project_name', default='gRNAde-process', type=str)
@@ -46,6 +72,7 @@ if __name__ == "__main__":
     parser.add_argument('--expt_name', dest='expt_name', default='process_data', type=str)
     parser.add_argument('--tags', nargs='+', dest='tags', default=[])
     parser.add_argument('--no_wandb', action="store_true")
+    parser.add_argument('--num_workers', dest='num_workers', default=os.cpu_count(), type=int)
     args, unknown = parser.parse_known_args()
 
     
@@ -105,21 +132,21 @@ if __name__ == "__main__":
     error_ids = []
 
     print(f"\nProcessing raw PDB files from {DATA_PATH}")
-    filenames = tqdm(os.listdir(os.path.join(DATA_PATH, "raw")))
-    for filename in filenames:
+    # parse structures and run the external secondary structure tools
+    # in parallel; results are collected by the main process in order
+    pdb_filenames = [filename for filename in os.listdir(os.path.join(DATA_PATH, "raw")) if os.path.splitext(filename)[1] == ".pdb"]
+    executor = ProcessPoolExecutor(max_workers=args.num_workers)
+    filenames = tqdm(zip(pdb_filenames, executor.map(load_pdb_file, pdb_filenames)), total=len(pdb_filenames))
+    for filename, (output, error) in filenames:
         try:
             structure_id, file_ext = os.path.splitext(filename)
             filenames.set_description(structure_id)
-            if file_ext != ".pdb": continue
+            if error is not None: raise error
 
             # if structure_id in ["357D_1_C-B-A","8G5N_1_R", "6HXX_1_Bb"]:
             #     dummy = 2
-            sequence, coords, sec_struct, sasa, sec_bp = pdb_to_tensor_2(
-                os.path.join(DATA_PATH, "raw", filename),
-            #    os.path.join(DATA_PATH, "fr3d", structure_id + "_basepair.txt"),
-                keep_insertions=keep_insertions,
-                keep_pseudoknots=False
-            )
+            sequence, coords, sec_struct, sasa, sec_bp = output
+            coords = torch.from_numpy(coords)
             
             # basic post processing validation:
             # do not include sequences with less than 10 nucleotides,
@@ -191,6 +218,7 @@ if __name__ == "__main__":
         except Exception as e:
             print(structure_id, e)
             error_ids.append((structure_id, e))
+    executor.shutdown()
 
     print(f"\nSaving (partially) processed data to {DATA_PATH}")
     torch.save(seq_to_data, os.path.join(DATA_PATH, "processed.pt"))
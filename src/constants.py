@@ -17,6 +17,12 @@ DSSR_PATH = os.environ.get("DSSR")
 
 ETERNAFOLD_PATH = os.environ.get("ETERNAFOLD")
 
+# Directory caching secondary structures extracted from PDB files on disk (disabled if None)
+SEC_STRUCT_CACHE_PATH = os.environ.get(
+    "SEC_STRUCT_CACHE", 
+    os.path.join(DATA_PATH, "sec_struct_cache") if DATA_PATH is not None else None
+)
+
 
 # Value to fill missing coordinate entries when reading PDB files
 FILL_VALUE = 1e-5
@@ -10,12 +10,15 @@ from typing import Any, List, Literal, Optional
 import torch
 import cpdb
 
-from src.data.sec_struct_utils import pdb_to_sec_struct, pdb_to_sec_struct_bp
+from src.data.sec_struct_utils import (
+    pdb_to_sec_struct,
+    pdb_to_sec_struct_bp,
+    load_structure_cached
+)
 
 from src.constants import PROJECT_PATH
 
 import biotite
-from biotite.structure.io import load_structure
 from biotite.structure import sasa as get_sasa
 from biotite.structure import apply_residue_wise
 
@@ -98,7 +101,7 @@ def pdb_to_tensor(
     sasa = None
     if return_sasa:
         # get solvent accessibile surface area
-        atom_array = load_structure(filepath)
+        atom_array = load_structure_cached(filepath)
         sasa = apply_residue_wise(
             atom_array,
             get_sasa(atom_array),
@@ -339,7 +342,8 @@ def pdb_to_tensor_2(
         return_sec_struct: bool = True,
         return_sasa: bool = True,
         keep_insertions: bool = True, 
-        keep_pseudoknots: bool = False
+        keep_pseudoknots: bool = False,
+        use_cache: bool = False
     ):
     """
     Reads a PDB file of an RNA structure and returns:
@@ -360,6 +364,8 @@ def pdb_to_tensor_2(
             PDB file. Defaults to True.
         keep_pseudoknots (bool, optional): Whether to keep pseudoknots in 
             secondary structure. Defaults to False.
+        use_cache (bool, optional): Whether to cache secondary structures on
+            disk at SEC_STRUCT_CACHE_PATH. Defaults to False.
     
     Returns:
         sequence (str): RNA sequence
@@ -398,20 +404,24 @@ def pdb_to_tensor_2(
     sec_struct = None
     if return_sec_struct:
         # get secondary structure
-        sec_struct = pdb_to_sec_struct(filepath, sequence, keep_pseudoknots)
+        sec_struct = pdb_to_sec_struct(filepath, sequence, keep_pseudoknots, use_cache=use_cache)
         assert len(sec_struct) == len(sequence), "Sequence and secondary structure must be the same length"
 
     sec_bp = None
     # fr3d_bp = None
-    pdb_map = dict(zip(df.residue_id.unique(),np.arange(1,len(sequence)+1)))
+    # map (chain, residue name, residue number, insertion) tuples to positions
+    pdb_map = dict(zip(
+        [tuple(res.split(":")) for res in df.residue_id.unique()],
+        np.arange(1,len(sequence)+1)
+    ))
     if return_sec_struct:
         # get secondary structure
-        sec_bp = pdb_to_sec_struct_bp(filepath, sequence, pdb_map, keep_pseudoknots)
+        sec_bp = pdb_to_sec_struct_bp(filepath, sequence, pdb_map, keep_pseudoknots, use_cache=use_cache)
            
     sasa = None
     if return_sasa:
         # get solvent accessibile surface area
-        atom_array = load_structure(filepath)
+        atom_array = load_structure_cached(filepath)
         sasa = apply_residue_wise(
             atom_array,
             get_sasa(atom_array),
@@ -88,7 +88,11 @@ class RNADesignDataset(data.Dataset):
                     coords_list.append(coords)
             
             if len(coords_list) > 0:
-                # Add processed coords_list to self.data_list
+                # Add processed coords_list to self.data_list, stacked once
+                # so the featurizer can sample conformers by indexing
+                coords_list = torch.stack(coords_list)
+                if torch.device(device).type == 'cuda':
+                    coords_list = coords_list.pin_memory()
                 rna['coords_list'] = coords_list
                 self.data_list.append(rna)
 
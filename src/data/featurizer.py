@@ -4,21 +4,27 @@
 ######################################################################
 
 import math
+import functools
 import numpy as np
 from typing import Optional, Tuple
 import torch
 import torch.nn.functional as F
 import torch_geometric
-from torch_geometric.utils import coalesce, to_undirected
+from torch_geometric.utils import coalesce
 import torch_cluster
-from sklearn.cluster import DBSCAN
-import random
+import numba
+from scipy.spatial import cKDTree
 from src.data.data_utils import *
 from src.data.sec_struct_utils import get_unpaired
 
 from src.constants import RNA_NUCLEOTIDES, RNA_ATOMS, DISTANCE_EPS
 
 
+# Range of distances covered by the edge RBF expansion
+RBF_VALUE_MIN = 0.0
+RBF_VALUE_MAX = 30.0
+
+
 class RNAGraphFeaturizer(object):
     """RNA Graph Featurizer
     
@@ -67,6 +73,14 @@ class RNAGraphFeaturizer(object):
         self.distance_eps = distance_eps
         self.device = device
 
+        # RBF centers are fixed, so build them once rather than on every call
+        self.rbf_centers = torch.linspace(
+            RBF_VALUE_MIN, RBF_VALUE_MAX, num_rbf, device=device)
+        self.rbf_inv_std = (num_rbf - 1) / (RBF_VALUE_MAX - RBF_VALUE_MIN)
+
+        # Reusable noise buffer, allocated on first use
+        self._noise_buf = None
+
         # nucleotide mapping: {'A': 0, 'G': 1, 'C': 2, 'U': 3, '_': 4}
         self.letter_to_num = dict(zip(
             RNA_NUCLEOTIDES, 
@@ -89,19 +103,16 @@ class RNAGraphFeaturizer(object):
                 rna['coords_list'], rna[self.base_pairing], k = self.max_num_conformers
             )
 
-            coords_list = torch.as_tensor(
-                coords_list, 
-                device=self.device, 
-                dtype=torch.float32
-            )
+            # Single host-to-device transfer of the sampled conformers
+            coords_list = coords_list.to(self.device, dtype=torch.float32, non_blocking=True)
 
             # Add gaussian noise during training 
             # (prevent overfitting on crystalisation artifacts)
             if self.split == 'train':
-                coords_list += torch.randn_like(coords_list, device=self.device) * self.noise_scale
+                coords_list.add_(self._coords_noise(coords_list))
 
             # Mask for missing coordinates for any backbone atom: num_res
-            mask_coords = torch.BoolTensor(mask_coords)
+            mask_coords = torch.as_tensor(mask_coords, dtype=torch.bool, device=self.device)
             # Also mask non-standard nucleotides
             mask_coords = (mask_coords) & (seq != self.letter_to_num["_"])
 
@@ -122,65 +133,60 @@ class RNAGraphFeaturizer(object):
             if (mask_coords == False).sum() > 0:
                 basepairs_all = offset_basepairs(basepairs_all,mask_coords)
             # Mask for extra coordinates if fewer than num_conf: num_res x num_conf
-            mask_confs = torch.BoolTensor(mask_confs).repeat(len(seq), 1)
+            mask_confs = torch.as_tensor(mask_confs, dtype=torch.bool, device=self.device).unsqueeze(0).expand(len(seq), -1).contiguous()
 
             edge_index = []
            
             # ===============modified============================
             unpaired_all = [get_unpaired(len(seq),basepairs_all[i]) for i in range(len(basepairs_all))]
-            all_idx =  torch.tensor([i for i in range(len(seq))])
             # primary structure edges
-            edge_index_primary = torch.stack((all_idx[:-1],all_idx[1:]), dim = 0)
-            edge_index_primary_all = to_undirected(edge_index_primary)
+            edge_index_primary_all = _primary_edges(len(seq))
             edge_index_secondary_all = []
             edge_index_tertiary_all = []
             for k in range(self.max_num_conformers):
                 
                 # secondary structure edges
                 bp_all = basepairs_all[k]
-                bp = [bp_all[i] for i in range(len(bp_all)) if abs(bp_all[i][1] - bp_all[i][0]) != 1]
-                bp1 = [bp[i][0]-1  for i in range(len(bp))]
-                bp2 = [bp[i][1]-1  for i in range(len(bp))]
-                edge_index_secondary = to_undirected(torch.stack((torch.tensor(bp1),torch.tensor(bp2)),dim = 0))
+                bp = bp_all[np.abs(bp_all[:,1] - bp_all[:,0]) != 1] - 1
+                # drop repeated pairs so both directions can be added without coalescing
+                bp = np.unique(np.sort(bp, axis=1), axis=0)
+                edge_index_secondary = add_reverse_edges(torch.from_numpy(bp.T.copy()))
                 edge_index_secondary_all.append(edge_index_secondary)
 
                 # tertiary structure edges
                 #========================================================================comment out to eliminate tertiary-type edges=================================================
                 edge_index_tertiary_directed = unpaired_cluster_dbscan(unpaired_all[k], coords_list[k], primary_dist = self.primary_dist, dbscan_eps = self.radius)
-                if len(edge_index_tertiary_directed[0]) > 2*seq.shape[0]:
-                    choices=random.sample(range(len(edge_index_tertiary_directed[0])),2*seq.shape[0])
-                    edge_index_tertiary_directed=edge_index_tertiary_directed[:,choices]
+                num_tertiary = edge_index_tertiary_directed.shape[1]
+                if num_tertiary > 2*seq.shape[0]:
+                    choices = torch.randperm(num_tertiary, device=edge_index_tertiary_directed.device)[:2*seq.shape[0]]
+                    edge_index_tertiary_directed = edge_index_tertiary_directed[:,choices]
                
-                edge_index_tertiary = to_undirected(edge_index_tertiary_directed)    
+                # DBSCAN edges are unique (i, j) pairs with i < j
+                edge_index_tertiary = add_reverse_edges(edge_index_tertiary_directed)
                 #========================================================================end==========================================================================================
                 # edge_index_tertiary = torch.empty((2,0), dtype=torch.int64)       
                 edge_index_tertiary_all.append(edge_index_tertiary)
 
-            edge_index_list = []
-            edge_vectors_list = []
-            edge_lengths_list = []
-            p_s_t_map_list = []
-            dim1 = coords_list[0,0].shape[0];dim2 = coords_list[0,0].shape[1]
+            # All conformers' edges in one tensor, laid out as
+            # [primary, secondary_k, tertiary_k] for k = 0, ..., num_conf - 1
+            edge_segments = []
             for k in range(self.max_num_conformers):
-                primary = coords_list[k][edge_index_primary_all[0]] - coords_list[k][edge_index_primary_all[1]]
-                secondary=torch.empty(0,dim1,dim2)
-                if edge_index_secondary_all[k].shape[1] > 0:
-                    secondary = coords_list[k][edge_index_secondary_all[k][0]] - coords_list[k][edge_index_secondary_all[k][1]]
-                tertiary=torch.empty(0,dim1,dim2)
-                if edge_index_tertiary_all[k].shape[1] > 0:
-                    tertiary = coords_list[k][edge_index_tertiary_all[k][0]] - coords_list[k][edge_index_tertiary_all[k][1]]
-                cur_edge_index = torch.cat((edge_index_primary_all,edge_index_secondary_all[k],edge_index_tertiary_all[k]), dim = -1)
-                cur_edge_vectors = torch.cat((primary, secondary, tertiary), dim = 0)
-                cur_edge_lengths = torch.sqrt((cur_edge_vectors ** 2).sum(dim=-1) + self.distance_eps)
-                p_mask=torch.tensor([0]); s_mask=torch.tensor([1]); t_mask=torch.tensor([2])
-                cur_p_s_t_map = torch.cat((p_mask.repeat(edge_index_primary_all.shape[-1]),
-                                           s_mask.repeat(edge_index_secondary_all[k].shape[-1]),
-                                           t_mask.repeat(edge_index_tertiary_all[k].shape[-1])), dim = 0)
-                
-                edge_index_list.append(cur_edge_index)
-                edge_vectors_list.append(normed_vec(cur_edge_vectors))
-                edge_lengths_list.append(cur_edge_lengths)
-                p_s_t_map_list.append(cur_p_s_t_map) 
+                edge_segments += [edge_index_primary_all, edge_index_secondary_all[k], edge_index_tertiary_all[k]]
+            segment_sizes = torch.tensor([segment.shape[-1] for segment in edge_segments])
+            edge_index_all = torch.cat(edge_segments, dim = -1)
+            # primary/secondary/tertiary edge type and conformer of each edge
+            p_s_t_map_all = torch.repeat_interleave(torch.tensor([0, 1, 2]).repeat(self.max_num_conformers), segment_sizes)
+            conf_id = torch.repeat_interleave(torch.arange(self.max_num_conformers).repeat_interleave(3), segment_sizes)
+            num_edges = segment_sizes.view(self.max_num_conformers, 3).sum(-1).tolist()
+            edge_index_list = list(torch.split(edge_index_all, num_edges, dim = -1))
+            p_s_t_map_list = list(torch.split(p_s_t_map_all, num_edges))
+
+            # Edge features for all conformers at once: gather (conformer, src, dst) triples
+            edge_index_all = edge_index_all.to(coords_list.device)
+            conf_id = conf_id.to(coords_list.device)
+            edge_vectors = coords_list[conf_id, edge_index_all[0]] - coords_list[conf_id, edge_index_all[1]]
+            edge_lengths = torch.sqrt((edge_vectors ** 2).sum(dim=-1) + self.distance_eps)
+            edge_rbf = rbf_expansion(edge_lengths, self.rbf_centers, self.rbf_inv_std)
 
             # Reshape: num_res x num_conf x ...
             coords_list = coords_list.permute(1, 0, 2, 3) # coords_list[:, :, 1].permute(1, 0, 2)
@@ -190,11 +196,16 @@ class RNAGraphFeaturizer(object):
             node_s = internal_coords_feat
             node_v = internal_vecs_feat
             
-            edge_v_list = edge_vectors_list
-            edge_s_list = []
-            for k in range(self.max_num_conformers):
-                cur_edge_rbf = rbf_expansion(edge_lengths_list[k], num_rbf=self.num_rbf)
-                edge_s_list.append(torch.cat([cur_edge_rbf, torch.log(edge_lengths_list[k])], dim=-1))
+            if self.distance_eps == DISTANCE_EPS:
+                # Reuse the smoothed lengths, which equal the denominator of normed_vec
+                edge_v = edge_vectors / edge_lengths.unsqueeze(-1)
+            else:
+                # normed_vec smooths with DISTANCE_EPS, not the configured eps
+                edge_v = normed_vec(edge_vectors)
+
+            # Split back into per-conformer lists
+            edge_v_list = list(torch.split(edge_v, num_edges))
+            edge_s_list = list(torch.split(torch.cat([edge_rbf, torch.log(edge_lengths)], dim=-1), num_edges))
             
         data = torch_geometric.data.Data(
             seq = seq,                  # num_res x 1
@@ -210,6 +221,20 @@ class RNAGraphFeaturizer(object):
         
         return data
     
+    def _coords_noise(self, coords_list):
+        """
+        Gaussian noise of the same shape as `coords_list`, written into a
+        buffer that is only reallocated when a larger RNA is seen.
+
+        Noise is drawn from the global RNG, which the DataLoader seeds 
+        separately in each worker.
+        """
+        numel = coords_list.numel()
+        if self._noise_buf is None or self._noise_buf.numel() < numel:
+            self._noise_buf = torch.empty(numel, device=coords_list.device, dtype=coords_list.dtype)
+        noise = self._noise_buf[:numel].view_as(coords_list)
+        return noise.normal_(0, self.noise_scale)
+
     def featurize(self, rna):
         """
         Featurize RNA backbone from dictionary of tensors.
@@ -321,14 +346,7 @@ def internal_coords(
     )
 
     # Compute internal coordinates associated with -[P]-[C4']-
-    PC4p_L = _lengths(X_chain[:, 1:, :], X_chain[:, :-1, :])
-    PC4p_A = _angles(X_chain[:, :-2, :], X_chain[:, 1:-1, :], X_chain[:, 2:, :])
-    PC4p_D = _dihedrals(
-        X_chain[:, :-3, :],
-        X_chain[:, 1:-2, :],
-        X_chain[:, 2:-1, :],
-        X_chain[:, 3:, :],
-    )
+    PC4p_L, PC4p_A, PC4p_D = _backbone_ics(X_chain, distance_eps)
 
     # Compute internal coordinates associated with [C4']-[N]
     X_P, X_C4p, X_N = X.unbind(dim=2)
@@ -344,46 +362,53 @@ def internal_coords(
     # Note: this could probably also be expressed as a Conv, unclear
     # which is faster and this probably not rate-limiting.
     C = C * (mask.type(torch.long))
-    ii = torch.stack(2 * [C], dim=-1).view([num_batch, -1])
-    L0, L1 = ii[:, :-1], ii[:, 1:]
-    A0, A1, A2 = ii[:, :-2], ii[:, 1:-1], ii[:, 2:]
-    D0, D1, D2, D3 = ii[:, :-3], ii[:, 1:-2], ii[:, 2:-1], ii[:, 3:]
-
-    # Mask for linear backbone
-    mask_L = torch.eq(L0, L1)
-    mask_A = torch.eq(A0, A1) * torch.eq(A0, A2)
-    mask_D = torch.eq(D0, D1) * torch.eq(D0, D2) * torch.eq(D0, D3)
-    mask_L = mask_L.type(torch.float32)
-    mask_A = mask_A.type(torch.float32)
-    mask_D = mask_D.type(torch.float32)
-
-    # Masks for branched nitrogen
-    mask_N_D = torch.eq(C[:, :-1], C[:, 1:])
-    mask_N_D = mask_N_D.type(torch.float32)
-    mask_N_A = mask
-    mask_N_L = mask
-
-    def _pad_pack(D, A, L, N_D, N_A, N_L):
-        # Pad and pack together the components
-        D = F.pad(D, (1, 2))
-        A = F.pad(A, (1, 1))
-        L = F.pad(L, (0, 1))
-        N_D = F.pad(N_D, (0, 1))
-        D, A, L = [x.reshape(num_batch, num_residues, 2) for x in [D, A, L]]
-        _pack = lambda a, b: torch.cat([a, b.unsqueeze(-1)], dim=-1)
-        L = _pack(L, N_L)
-        A = _pack(A, N_A)
-        D = _pack(D, N_D)
-        return D, A, L
-
-    D, A, L = _pad_pack(PC4p_D, PC4p_A, PC4p_L, N_D, N_A, N_L)
-    mask_D, mask_A, mask_L = _pad_pack(
-        mask_D, mask_A, mask_L, mask_N_D, mask_N_A, mask_N_L
-    )
-    mask_expand = mask.unsqueeze(-1)
-    mask_D = mask_expand * mask_D
-    mask_A = mask_expand * mask_A
-    mask_L = mask_expand * mask_L
+    # Residues i and i+1 lie on the same chain: num_batch x (num_residues - 1)
+    eq = torch.eq(C[:, 1:], C[:, :-1])
+
+    def _write_beads(out, values, offset):
+        # Write per-bead values starting at bead `offset` into the first two
+        # columns of `out`, where bead 2i is P and bead 2i+1 is C4' of residue i
+        for col in range(2):
+            first = (col - offset) % 2
+            cur_values = values[:, first::2]
+            start = (first + offset) // 2
+            out[:, start:start + cur_values.shape[1], col] = cur_values
+
+    def _pack(D, A, L, N_D, N_A, N_L):
+        # Pack the components into preallocated (num_batch, num_residues, 3)
+        # outputs; entries without a defined value stay zero
+        D_out, A_out, L_out = [D.new_zeros((num_batch, num_residues, 3)) for _ in range(3)]
+        _write_beads(D_out, D, 1)
+        _write_beads(A_out, A, 1)
+        _write_beads(L_out, L, 0)
+        D_out[:, :-1, 2] = N_D
+        A_out[:, :, 2] = N_A
+        L_out[:, :, 2] = N_L
+        return D_out, A_out, L_out
+
+    D, A, L = _pack(PC4p_D, PC4p_A, PC4p_L, N_D, N_A, N_L)
+
+    # Masks in the same packed layout, built per residue from `eq`:
+    # a bead-level term is valid when every residue it spans is on one chain
+    mask_D, mask_A, mask_L = [
+        torch.zeros((num_batch, num_residues, 3), dtype=torch.bool, device=X.device) for _ in range(3)
+    ]
+    # Linear backbone
+    mask_L[:, :, 0] = True
+    mask_L[:, :-1, 1] = eq
+    mask_A[:, 1:, 0] = eq
+    mask_A[:, :-1, 1] = eq
+    mask_D[:, 1:-1, 0] = eq[:, :-1] & eq[:, 1:]
+    mask_D[:, :-1, 1] = eq
+    # Branched nitrogen
+    mask_L[:, :, 2] = True
+    mask_A[:, :, 2] = True
+    mask_D[:, :-1, 2] = eq
+
+    mask_expand = (C > 0).unsqueeze(-1)
+    mask_D = (mask_expand & mask_D).to(mask.dtype, copy=False)
+    mask_A = (mask_expand & mask_A).to(mask.dtype, copy=False)
+    mask_L = (mask_expand & mask_L).to(mask.dtype, copy=False)
 
     D = mask_D * D
     A = mask_A * A
@@ -395,6 +420,7 @@ def internal_coords(
         return D, A, L, mask_D, mask_A, mask_L
     
 
+@torch.jit.script
 def normed_vec(V: torch.Tensor, distance_eps: float = DISTANCE_EPS) -> torch.Tensor:
     """Normalized vectors with distance smoothing.
 
@@ -411,12 +437,11 @@ def normed_vec(V: torch.Tensor, distance_eps: float = DISTANCE_EPS) -> torch.Ten
         U (Tensor): Batch of normalized vectors with shape `(..., num_dims)`.
     """
     # Unit vector from i to j
-    mag_sq = (V ** 2).sum(dim=-1, keepdim=True)
-    mag = torch.sqrt(mag_sq + distance_eps)
-    U = V / mag
+    U = V * torch.rsqrt((V * V).sum(dim=-1, keepdim=True) + distance_eps)
     return U
 
 
+@torch.jit.script
 def normed_cross(
     V1: torch.Tensor, V2: torch.Tensor, distance_eps: float = DISTANCE_EPS
 ) -> torch.Tensor:
@@ -435,10 +460,21 @@ def normed_cross(
     Returns:
         C (Tensor): Batch of cross products `v_1 x v_2` with shape `(..., 3)`.
     """
-    C = normed_vec(torch.cross(V1, V2, dim=-1), distance_eps=distance_eps)
+    # Explicit components instead of torch.cross, so the cross product and
+    # the normalization stay one elementwise pipeline
+    a0, a1, a2 = V1.unbind(-1)
+    b0, b1, b2 = V2.unbind(-1)
+    C = torch.stack([a1 * b2 - a2 * b1, a2 * b0 - a0 * b2, a0 * b1 - a1 * b0], dim=-1)
+    C = C * torch.rsqrt((C * C).sum(dim=-1, keepdim=True) + distance_eps)
     return C
 
 
+@torch.jit.script
+def clamped_acos(x: torch.Tensor) -> torch.Tensor:
+    """Arc cosine of `x` clamped to [-1, 1], scripted as one fused op."""
+    return torch.acos(torch.clamp(x, -1.0, 1.0))
+
+
 def lengths(
     atom_i: torch.Tensor, atom_j: torch.Tensor, distance_eps: float = DISTANCE_EPS
 ) -> torch.Tensor:
@@ -484,9 +520,8 @@ def angles(
     # Bond angle of i-j-k
     U_ji = normed_vec(atom_i - atom_j, distance_eps=distance_eps)
     U_jk = normed_vec(atom_k - atom_j, distance_eps=distance_eps)
-    inner_prod = torch.einsum("bix,bix->bi", U_ji, U_jk)
-    inner_prod = torch.clamp(inner_prod, -1, 1)
-    A = torch.acos(inner_prod)
+    inner_prod = (U_ji * U_jk).sum(-1)
+    A = clamped_acos(inner_prod)
     if degrees:
         A = A * 180.0 / np.pi
     return A
@@ -520,39 +555,83 @@ def dihedrals(
     U_kl = normed_vec(atom_l - atom_k, distance_eps=distance_eps)
     normal_ijk = normed_cross(U_ij, U_jk, distance_eps=distance_eps)
     normal_jkl = normed_cross(U_jk, U_kl, distance_eps=distance_eps)
-    # _inner_product = lambda a, b: torch.einsum("bix,bix->bi", a, b)
-    _inner_product = lambda a, b: (a * b).sum(-1)
-    cos_dihedrals = _inner_product(normal_ijk, normal_jkl)
-    angle_sign = _inner_product(U_ij, normal_jkl)
-    cos_dihedrals = torch.clamp(cos_dihedrals, -1, 1)
-    D = torch.sign(angle_sign) * torch.acos(cos_dihedrals)
+    cos_dihedrals = (normal_ijk * normal_jkl).sum(-1)
+    angle_sign = (U_ij * normal_jkl).sum(-1)
+    D = torch.sign(angle_sign) * clamped_acos(cos_dihedrals)
     if degrees:
         D = D * 180.0 / np.pi
     return D
 
 
+@torch.jit.script
+def _backbone_ics(
+    X_chain: torch.Tensor, distance_eps: float = DISTANCE_EPS
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Bond lengths, angle complements and dihedrals along a linear chain.
+
+    Equivalent to calling `lengths`, `np.pi - angles` and `dihedrals` on
+    consecutive atoms of `X_chain`, but each bond vector is computed and
+    normalized once and shared by all three.
+
+    Args:
+        X_chain (Tensor): Chain coordinates with shape `(num_batch, num_atoms, 3)`.
+        distance_eps (float, optional): Distance smoothing parameter for
+            for computing distances as `sqrt(sum_sq) -> sqrt(sum_sq + eps)`.
+            Default: 1E-3.
+
+    Returns:
+        L (Tensor): Bond lengths with shape `(num_batch, num_atoms - 1)`.
+        A (Tensor): Angle complements with shape `(num_batch, num_atoms - 2)`.
+        D (Tensor): Dihedrals with shape `(num_batch, num_atoms - 3)`.
+    """
+    dX = X_chain[:, 1:] - X_chain[:, :-1]
+    L = torch.sqrt((dX * dX).sum(-1) + distance_eps)
+    U = dX / L.unsqueeze(-1)
+    # The complement of the angle between -U_i and U_i+1 is the angle between U_i and U_i+1
+    A = clamped_acos((U[:, :-1] * U[:, 1:]).sum(-1))
+    # Plane normals, shared between consecutive dihedrals
+    normals = normed_cross(U[:, :-1], U[:, 1:], distance_eps)
+    cos_dihedrals = (normals[:, :-1] * normals[:, 1:]).sum(-1)
+    angle_sign = (U[:, :-2] * normals[:, 1:]).sum(-1)
+    D = torch.sign(angle_sign) * clamped_acos(cos_dihedrals)
+    return L, A, D
+
+
+@torch.jit.script
 def rbf_expansion(
         h: torch.Tensor,
-        value_min: float = 0.0,
-        value_max: float = 30.0,
-        num_rbf: int = 32,
-    ):
-    rbf_centers = torch.linspace(value_min, value_max, num_rbf)
-    std = (rbf_centers[1] - rbf_centers[0]).item()
-    shape = list(h.shape)
-    shape_ones = [1 for _ in range(len(shape))] + [-1]
-    rbf_centers = rbf_centers.view(shape_ones)
-    h = torch.exp(-(((h.unsqueeze(-1) - rbf_centers) / std) ** 2))
-    h = h.view(shape[:-1] + [-1])
-    return h
+        rbf_centers: torch.Tensor,
+        rbf_inv_std: float,
+    ) -> torch.Tensor:
+    """Gaussian radial basis expansion of `h` around precomputed centers.
+
+    Args:
+        h (Tensor): Distances with shape `(..., num_bb_atoms)`.
+        rbf_centers (Tensor): RBF centers with shape `(num_rbf,)`.
+        rbf_inv_std (float): Inverse of the spacing between RBF centers.
+
+    Returns:
+        Tensor of shape `(..., num_bb_atoms x num_rbf)`.
+    """
+    h = (h.unsqueeze(-1) - rbf_centers).mul_(rbf_inv_std).pow_(2).neg_().exp_()
+    return h.flatten(-2)
+
+
+# Positional encoding frequencies per (num_posenc, period_range, device, dtype)
+_POSENC_W_CACHE = {}
 
 
 def positional_encoding(inputs, num_posenc=32, period_range=(1.0, 1000.0)):
     
-    num_frequencies = num_posenc // 2
-    log_bounds = np.log10(period_range)
-    p = torch.logspace(log_bounds[0], log_bounds[1], num_frequencies, base=10.0)
-    w = 2 * math.pi / p
+    dtype = inputs.dtype if inputs.is_floating_point() else torch.float32
+    key = (num_posenc, tuple(period_range), str(inputs.device), dtype)
+    w = _POSENC_W_CACHE.get(key)
+    if w is None:
+        num_frequencies = num_posenc // 2
+        log_bounds = np.log10(period_range)
+        p = torch.logspace(log_bounds[0], log_bounds[1], num_frequencies, base=10.0)
+        w = (2 * math.pi / p).to(device=inputs.device, dtype=dtype)
+        _POSENC_W_CACHE[key] = w
     
     batch_dims = list(inputs.shape)[:-1]
     # (..., 1, num_out) * (..., num_in, 1)
@@ -586,106 +665,176 @@ def normalize(tensor, dim=-1):
 
 #=====modified============================================
 def get_angle(vi,vj):
-    _inner_product = lambda a, b: (a * b).sum(-1)
-    cos = _inner_product(vi, vj)
-    
-    cos = torch.clamp(cos, -1, 1)
+    cos = (vi * vj).sum(-1)
     # D = torch.sign(cos) * torch.acos(cos)
-    D = torch.acos(cos)
+    D = clamped_acos(cos)
     # D * 180.0 / np.pi
     return D
 
 
+@functools.lru_cache(maxsize=4096)
+def _primary_edges(num_residues):
+    # Undirected backbone edges (i, i+1) depend only on the sequence length;
+    # callers must not modify the returned tensor in place
+    all_idx = torch.arange(num_residues)
+    return add_reverse_edges(torch.stack((all_idx[:-1], all_idx[1:]), dim = 0))
+
+
+def add_reverse_edges(edge_index):
+    """
+    Returns the undirected version of `edge_index` by appending each edge
+    in the reverse direction.
+
+    Cheaper than `to_undirected` as nothing is sorted or coalesced, so the
+    input must not contain duplicates or edges in both directions.
+    """
+    return torch.cat((edge_index, edge_index.flip(0)), dim = -1)
+
+
 def get_k_random_entries_and_masks_2(coords_list, basepairs, k):
     """
     Returns k random entries from a list of 3D coordinates, along with
     the corresponding masks (1 = valid, 0 = not valid).
     
     Args:
-        coords_list (list): List of np.array entries of 3D coordinates
+        coords_list (Tensor or list): Stacked 3D coordinates of shape
+            (num_conformers, num_residues, num_atoms, 3), or a list of entries
+        basepairs (list): List of base pairs per entry, as [i, j] 1-based indices
         k (int): number of random entries to be selected from coords_list
     
     Returns:
-        confs_list (np.array): Coordinates array of shape (k, num_residues, num_atoms, 3)
-        mask_coords (np.array): Mask of valid coordinates of shape (num_atoms)
-        mask_confs (np.array): Mask of valid conformers of shape (k)
+        confs_list (Tensor): Coordinates tensor of shape (k, num_residues, num_atoms, 3)
+        basepairs (list): Base pairs of the selected entries as (num_pairs, 2) int arrays
+        mask_coords (Tensor): Mask of valid coordinates of shape (num_residues)
+        mask_confs (Tensor): Mask of valid conformers of shape (k)
     """
-    n = len(coords_list)
-    coords_list = np.array(coords_list)
+    if not torch.is_tensor(coords_list):
+        coords_list = torch.stack([torch.as_tensor(coords, dtype=torch.float32) for coords in coords_list])
+    n = coords_list.shape[0]
+    device = coords_list.device
+    basepairs = [np.asarray(pairs, dtype=np.int64).reshape(-1, 2) for pairs in basepairs]
 
     if k > n:
         # If k is greater than the length of the list,
         # return all the entries in the list and pad random entries up to k
-        rand_idx = np.random.choice(n, size=k-n, replace=True)
-        confs_list = np.concatenate((coords_list, coords_list[rand_idx]), axis=0)
-        for idx in rand_idx:
-            basepairs.append(basepairs[idx])
-        mask_coords = (coords_list == FILL_VALUE).sum(axis=(0,2,3)) < 4
+        rand_idx = torch.randint(n, (k-n,), device=device)
+        all_idx = torch.cat((torch.arange(n, device=device), rand_idx))
+        confs_list = coords_list.index_select(0, all_idx)
+        basepairs = [basepairs[i] for i in all_idx.tolist()]
+        # counted over the distinct conformers, so the padding
+        # duplicates do not tighten the threshold
+        mask_coords = (coords_list == FILL_VALUE).sum(dim=(0,2,3)) < 4
         # if mask_coords[0] == False:
-        #     if (coords_list[:,0] == FILL_VALUE).sum(axis=(0,1,2)) < 4:
+        #     if (coords_list[:,0] == FILL_VALUE).sum(dim=(0,1,2)) < 4:
         #         mask_coords[0] = True
-        mask_confs = np.array([1]*k)
     else:
         # If k is less than or equal to the length of the list, 
         # randomly select k entries
-        rand_idx = np.random.choice(n, size=k, replace=False)
-        confs_list =  coords_list[rand_idx]
-        basepairs = [basepairs[i] for i in rand_idx]
-        mask_coords = (confs_list == FILL_VALUE).sum(axis=(0,2,3)) == 0
+        rand_idx = torch.randperm(n, device=device)[:k]
+        confs_list = coords_list.index_select(0, rand_idx)
+        basepairs = [basepairs[i] for i in rand_idx.tolist()]
+        mask_coords = (confs_list == FILL_VALUE).sum(dim=(0,2,3)) == 0
         if mask_coords[0] == False:
-            if (coords_list[:,0] == FILL_VALUE).sum(axis=(0,1,2)) < 4:
+            if (coords_list[:,0] == FILL_VALUE).sum() < 4:
                 mask_coords[0] = True
-        mask_confs = np.array([1]*k)
+    mask_confs = torch.ones(k, dtype=torch.bool, device=device)
 
     return confs_list, basepairs, mask_coords, mask_confs
 
+@numba.njit(cache=True)
+def _dbscan_inner(is_core, indptr, indices):
+    # Same expansion order as sklearn's dbscan_inner, so cluster labels match
+    labels = np.full(is_core.shape[0], -1, dtype=np.int64)
+    stack = np.empty(indices.shape[0] + 1, dtype=np.int64)
+    label_num = 0
+    for i in range(labels.shape[0]):
+        if labels[i] != -1 or not is_core[i]:
+            continue
+        cur = i
+        top = 0
+        while True:
+            if labels[cur] == -1:
+                labels[cur] = label_num
+                if is_core[cur]:
+                    for v in indices[indptr[cur]:indptr[cur + 1]]:
+                        if labels[v] == -1:
+                            stack[top] = v
+                            top += 1
+            if top == 0:
+                break
+            top -= 1
+            cur = stack[top]
+        label_num += 1
+    return labels
+
+
+def dbscan_3d(points, eps, min_samples=5):
+    """
+    DBSCAN clustering of a small set of 3D points.
+
+    Neighbourhoods are queried once from a KD-tree and the cluster expansion
+    runs in a numba kernel; results match `sklearn.cluster.DBSCAN`.
+
+    Args:
+        points (np.array): Coordinates of shape (num_points, 3)
+        eps (float): maximum distance between two neighbouring points
+        min_samples (int): neighbourhood size (including the point itself)
+            for a point to be a core point
+    
+    Returns:
+        labels (np.array): Cluster label per point, -1 for noise
+        core_mask (np.array): Boolean mask of core points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    neighborhoods = cKDTree(points).query_ball_point(points, eps)
+    counts = np.array([len(neighb) for neighb in neighborhoods], dtype=np.int64)
+    indptr = np.zeros(len(points) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate(neighborhoods).astype(np.int64)
+    core_mask = counts >= min_samples
+    labels = _dbscan_inner(core_mask, indptr, indices)
+    return labels, core_mask
+
+
 def unpaired_cluster_dbscan(unpaired_idx, coord, primary_dist = 500, dbscan_eps = 10):
-    edges_source = []
-    edges_dest = []
-    coord_mean = coord.mean(1)
-    unpaired_coords_mean = coord_mean[unpaired_idx]
-    if unpaired_coords_mean.shape[0] > 0:
-        db = DBSCAN(eps=dbscan_eps, min_samples=5).fit(unpaired_coords_mean)
+    # float64 keeps the expanded squared distances exact enough near the thresholds
+    coord_mean_np = coord.mean(1).detach().cpu().numpy().astype(np.float64)
+    idx_arr = np.asarray(unpaired_idx, dtype=np.int64)
+    if len(idx_arr) > 0:
+        labels, core_samples_mask = dbscan_3d(coord_mean_np[idx_arr], eps=dbscan_eps, min_samples=5)
     else:
-        dummy = 2
         return torch.empty((2,0), dtype=torch.int64) 
-    core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-    core_samples_mask[db.core_sample_indices_] = True
-    unique_labels = set(db.labels_)
-    for cur_label_idx in unique_labels:
-        if cur_label_idx != -1:
-            class_member_mask = db.labels_ == cur_label_idx
-            masks = class_member_mask & core_samples_mask
-            idx_mem = np.array(unpaired_idx)[masks]
-            # idx = unpaired_idx[class_member_mask]
-            for i in range(len(idx_mem)-1):
-                for j in range(i+1, len(idx_mem)):
-                    if (abs(idx_mem[i] - idx_mem[j]) > primary_dist) & (2 < dist_2(coord_mean[idx_mem[i]],coord_mean[idx_mem[j]]).item() < 2*dbscan_eps):
-                        edges_source.append(idx_mem[i])
-                        edges_dest.append(idx_mem[j])
-            
-    return torch.stack((torch.tensor(edges_source),torch.tensor(edges_dest)), dim = 0).to(torch.int64)
+    valid = (labels != -1) & core_samples_mask
+    edges_source = []
+    edges_dest = []
+    for cur_label_idx in np.unique(labels[valid]):
+        idx_mem = idx_arr[valid & (labels == cur_label_idx)]
+        if len(idx_mem) < 2:
+            continue
+        # pairwise squared distances via ||x||^2 + ||y||^2 - 2 x.y
+        P = coord_mean_np[idx_mem]
+        G = P @ P.T
+        sq_norm = np.diag(G)
+        sq_dist = sq_norm[:, None] + sq_norm[None, :] - 2 * G
+        i, j = np.triu_indices(len(idx_mem), 1)
+        keep = (np.abs(idx_mem[i] - idx_mem[j]) > primary_dist) \
+            & (sq_dist[i, j] > 4) & (sq_dist[i, j] < (2 * dbscan_eps) ** 2)
+        edges_source.append(idx_mem[i[keep]])
+        edges_dest.append(idx_mem[j[keep]])
+    if len(edges_source) == 0:
+        return torch.empty((2,0), dtype=torch.int64)
+    return torch.from_numpy(np.stack((np.concatenate(edges_source), np.concatenate(edges_dest)), axis=0)).to(torch.int64)
 
 def offset_basepairs(basepairs,masks):
+    # remap[i] is the new 1-based index of residue i, or 0 if it was masked out
+    masks = torch.as_tensor(masks).cpu().numpy()
+    remap = np.zeros(len(masks)+1, dtype=np.int64)
+    remap[1:][masks] = np.arange(start=1, stop=masks.sum()+1, step=1)
     return_bp = []
-    pair_map = np.arange(start=1, stop=len(masks)+1, step=1)
-    pair_masked_keys = pair_map[masks]
-    pair_masked_vals = np.arange(start=1, stop=len(pair_masked_keys)+1, step=1)
-    dict = {}
-    for key, val in zip(pair_masked_keys, pair_masked_vals):
-        dict[key] = val
     for k in range(len(basepairs)):
-        cur_basepairs_1 = [dict.get(basepairs[k][i][0],0) for i in range(len(basepairs[k]))]
-        cur_basepairs_2 = [dict.get(basepairs[k][i][1],0) for i in range(len(basepairs[k]))]
-        cur_basepairs = []
-        for idx in range(len(basepairs[k])):
-            if (cur_basepairs_1[idx] != 0) and ((cur_basepairs_2[idx] != 0)):
-                cur_basepairs.append([cur_basepairs_1[idx],cur_basepairs_2[idx]])
-        return_bp.append(cur_basepairs)
+        if len(basepairs[k]) == 0:
+            return_bp.append(np.empty((0,2), dtype=np.int64))
+            continue
+        cur_basepairs = remap[np.asarray(basepairs[k], dtype=np.int64)]
+        return_bp.append(cur_basepairs[(cur_basepairs > 0).all(axis=1)])
     return return_bp
-                    
-
-            
-                 
-                        
-            
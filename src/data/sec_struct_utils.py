@@ -4,12 +4,17 @@
 ######################################################################
 
 import os
-import glob
+import re
+import csv
+import pickle
+import hashlib
+import functools
 import subprocess
-from datetime import datetime
+import tempfile
 import numpy as np
-import wandb
-from typing import Any, List, Literal, Optional
+import numba
+from scipy.sparse import csr_matrix, spmatrix
+from typing import Any, List, Literal, Optional, Union
 
 from Bio import SeqIO
 from Bio.Seq import Seq
@@ -17,23 +22,106 @@ from Bio.SeqRecord import SeqRecord
 
 import biotite
 from biotite.structure.io import load_structure
-from biotite.structure import dot_bracket_from_structure
+from biotite.structure import (
+    AtomArrayStack,
+    dot_bracket_from_structure,
+    filter_nucleotides,
+    get_residue_count
+)
 
 from src.constants import (
-    PROJECT_PATH,
     X3DNA_PATH,
     DSSR_PATH,
     ETERNAFOLD_PATH, 
+    SEC_STRUCT_CACHE_PATH,
     DOTBRACKET_TO_NUM
 )
 
 
+# Minimum number of nucleotides in a PDB file for biotite to annotate base pairs
+MIN_LEN_FOR_BIOTITE = 2
+
+
+# Translation table mapping all pseudoknot brackets in dot-bracket notation to '.'
+_REMOVE_PSEUDOKNOTS = str.maketrans(
+    {chr(c): '.' for c in range(256) if chr(c) not in '.()'}
+)
+
+
+# Maximum number of parsed PDB files kept in memory by `load_structure_cached`.
+# Processing loads each PDB file twice in a row (secondary structure, then SASA)
+# and never returns to it, so one entry per process covers every reuse without
+# holding on to large structures
+STRUCTURE_CACHE_SIZE = 1
+
+
+@functools.lru_cache(maxsize=STRUCTURE_CACHE_SIZE)
+def _load_structure_cached(pdb_file_path: str, mtime: float):
+    return load_structure(pdb_file_path)
+
+
+def load_structure_cached(pdb_file_path: str):
+    """
+    Load a PDB file as a biotite AtomArray, reusing the parsed structure when
+    the same file is loaded again and has not been modified since.
+
+    The returned AtomArray is shared between callers and must not be modified
+    in place.
+    """
+    return _load_structure_cached(pdb_file_path, os.path.getmtime(pdb_file_path))
+
+
+def _sec_struct_cache_key(pdb_file_path: str) -> str:
+    with open(pdb_file_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _pdb_map_digest(pdb_map: dict) -> str:
+    return hashlib.sha1(
+        repr([(key, int(value)) for key, value in pdb_map.items()]).encode("utf-8")
+    ).hexdigest()
+
+
+def _load_sec_struct_cache_entry(key: str) -> dict:
+    try:
+        with open(os.path.join(SEC_STRUCT_CACHE_PATH, f"{key}.pkl"), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        # not cached yet, or unreadable
+        return {}
+
+
+def _read_sec_struct_cache(key: str, field: tuple) -> Any:
+    """
+    Return a field of the on-disk secondary structure cache entry of a PDB 
+    file, or None if it has not been cached yet. `pdb_to_sec_struct` and 
+    `pdb_to_sec_struct_bp` store their results as separate fields of the
+    same entry, each identified by all the arguments the result depends on.
+    """
+    return _load_sec_struct_cache_entry(key).get(field)
+
+
+def _write_sec_struct_cache(key: str, field: tuple, value: Any) -> None:
+    # one file per PDB file, replaced atomically so that concurrent
+    # processes never read a partially written entry
+    entry = _load_sec_struct_cache_entry(key)
+    entry[field] = value
+    try:
+        os.makedirs(SEC_STRUCT_CACHE_PATH, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=SEC_STRUCT_CACHE_PATH, delete=False) as f:
+            pickle.dump(entry, f)
+        os.replace(f.name, os.path.join(SEC_STRUCT_CACHE_PATH, f"{key}.pkl"))
+    except OSError:
+        pass
+
+
 def pdb_to_sec_struct(
         pdb_file_path: str,
         sequence: str,
         keep_pseudoknots: bool = False,
         x3dna_path: str = os.path.join(X3DNA_PATH, "bin/find_pair"),
         max_len_for_biotite: int = 1000,
+        use_cache: bool = False,
     ) -> str:
     """
     Get secondary structure in dot-bracket notation from a PDB file.
@@ -46,27 +134,39 @@ def pdb_to_sec_struct(
         x3dna_path (str, optional): Path to x3dna find_pair tool.
         max_len_for_biotite (int, optional): Maximum length of sequence for
             which to use biotite. Otherwise use X3DNA Defaults to 1000.
+        use_cache (bool, optional): Whether to look up and store the result 
+            in the on-disk cache at SEC_STRUCT_CACHE_PATH, keyed by the contents
+            of the PDB file and all other arguments. Defaults to False.
     """
+    cache_key = None
+    if use_cache and SEC_STRUCT_CACHE_PATH is not None:
+        cache_key = _sec_struct_cache_key(pdb_file_path)
+        cache_field = ("sec_struct", sequence, keep_pseudoknots, x3dna_path, max_len_for_biotite)
+        sec_struct = _read_sec_struct_cache(cache_key, cache_field)
+        if sec_struct is not None:
+            return sec_struct
+
+    sec_struct = None
     if len(sequence) < max_len_for_biotite:
         try:
-            # get secondary structure using biotite
-            atom_array = load_structure(pdb_file_path)
-            sec_struct = dot_bracket_from_structure(atom_array)[0]
-            if not keep_pseudoknots:
-                # replace all characters that are not '.', '(', ')' with '.'
-                sec_struct = "".join([dotbrac if dotbrac in ['.', '(', ')'] else '.' for dotbrac in sec_struct])
+            atom_array = load_structure_cached(pdb_file_path)
+            # biotite fails for very short seqeunces, which cannot have 
+            # base pairs anyway, so route them to x3dna upfront
+            model = atom_array[0] if isinstance(atom_array, AtomArrayStack) else atom_array
+            num_nucleotides = get_residue_count(model[filter_nucleotides(model)])
+            if num_nucleotides >= MIN_LEN_FOR_BIOTITE:
+                # get secondary structure using biotite
+                sec_struct = dot_bracket_from_structure(atom_array)[0]
+                if not keep_pseudoknots:
+                    # replace all characters that are not '.', '(', ')' with '.'
+                    sec_struct = sec_struct.translate(_REMOVE_PSEUDOKNOTS)
         
         except Exception as e:
-            # biotite fails for very short seqeunces
+            # remaining biotite failures also fall back to x3dna
             if "out of bounds for array" not in str(e): raise e
-            # get secondary structure using x3dna find_pair tool
-            # does not support pseudoknots
-            sec_struct = x3dna_to_sec_struct(
-                pdb_to_x3dna(pdb_file_path, x3dna_path), 
-                sequence
-            )
+            sec_struct = None
 
-    else:
+    if sec_struct is None:
         # get secondary structure using x3dna find_pair tool
         # does not support pseudoknots
         sec_struct = x3dna_to_sec_struct(
@@ -74,6 +174,8 @@ def pdb_to_sec_struct(
             sequence
         )
     
+    if cache_key is not None:
+        _write_sec_struct_cache(cache_key, cache_field, sec_struct)
     return sec_struct
 
 def pdb_to_x3dna(
@@ -83,32 +185,63 @@ def pdb_to_x3dna(
     # Run x3dna find_pair tool
     cmd = [
         x3dna_path,
-        pdb_file_path,
+        os.path.abspath(pdb_file_path),
     ]
-    output = subprocess.run(cmd, check=True, capture_output=True).stdout.decode("utf-8")
+    # find_pair writes scratch files (bestpairs.pdb, bp_order.dat, col_chains.scr,
+    # col_helices.scr, hel_regions.pdb, ref_frames.dat) to its working directory,
+    # which are deleted together with the temporary directory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = subprocess.run(cmd, cwd=tmp_dir, check=True, capture_output=True).stdout.decode("utf-8")
     output = output.split("\n")
 
-    # Delete temporary files
-    # os.remove("./bestpairs.pdb")
-    # os.remove("./bp_order.dat")
-    # os.remove("./col_chains.scr")
-    # os.remove("./col_helices.scr")
-    # os.remove("./hel_regions.pdb")
-    # os.remove("./ref_frames.dat")
-
     return output
 
 
 def x3dna_to_sec_struct(output: List[str], sequence: str) -> str:
     # Secondary structure in dot-bracket notation
     num_base_pairs = int(output[3].split()[0])
-    sec_struct = ["."] * len(sequence)
-    for i in range(1, num_base_pairs+1):
-        line = output[4 + i].split()
-        start, end = int(line[0]), int(line[1])
-        sec_struct[start-1] = "("
-        sec_struct[end-1] = ")"
-    return "".join(sec_struct)
+    # (start, end) of each base pair, 0-indexed and flattened in row order
+    idx = np.array(
+        [line.split()[:2] for line in output[5:5 + num_base_pairs]], dtype=np.int64
+    ).reshape(-1) - 1
+    sec_struct = np.full(len(sequence), ord("."), dtype=np.uint8)
+    sec_struct[idx] = np.tile(np.frombuffer(b"()", dtype=np.uint8), num_base_pairs)
+    return sec_struct.tobytes().decode("ascii")
+
+
+@functools.lru_cache(maxsize=None)
+def _eternafold_reads_stdin(eternafold_path: str) -> bool:
+    """
+    Whether EternaFold accepts fasta input piped through /dev/stdin, probed 
+    once per binary on a known-good sequence. Some builds open the input
+    file more than once, which a pipe does not allow.
+    """
+    if not os.path.exists("/dev/stdin"):
+        return False
+    fasta = SeqRecord(Seq("GGGAAACCC"), id="probe").format("fasta")
+    proc = subprocess.run(
+        [eternafold_path, "predict", "/dev/stdin"], 
+        input=fasta.encode("utf-8"), capture_output=True
+    )
+    return proc.returncode == 0 and len(proc.stdout.strip()) > 0
+
+
+def _run_eternafold_on_fasta(cmd: List[str], fasta: str) -> str:
+    """
+    Run an EternaFold command on a fasta record given as text.
+
+    The record is piped to EternaFold through /dev/stdin if supported, or
+    written to a temporary fasta file otherwise.
+    """
+    if _eternafold_reads_stdin(cmd[0]):
+        return subprocess.run(
+            cmd + ["/dev/stdin"], input=fasta.encode("utf-8"), check=True, capture_output=True
+        ).stdout.decode("utf-8")
+
+    with tempfile.NamedTemporaryFile("w", suffix=".fasta") as f:
+        f.write(fasta)
+        f.flush()
+        return subprocess.run(cmd + [f.name], check=True, capture_output=True).stdout.decode("utf-8")
 
 
 def predict_sec_struct(
@@ -131,26 +264,12 @@ def predict_sec_struct(
         eternafold_path (str, optional): Path to EternaFold. Defaults to ETERNAFOLD_PATH env variable.
         n_samples (int, optional): Number of samples to take. Defaults to 1.
     """
-    if sequence is not None:
-        assert fasta_file_path is None
-        # Write sequence to temporary fasta file
-        current_datetime = datetime.now().strftime("%Y%m%d_%H%M%S")
-        try:
-            fasta_file_path = os.path.join(wandb.run.dir, f"temp_{current_datetime}.fasta")
-        except AttributeError:
-            fasta_file_path = os.path.join(PROJECT_PATH, f"temp_{current_datetime}.fasta")
-        SeqIO.write(
-            SeqRecord(Seq(sequence), id="temp"),
-            fasta_file_path, "fasta"
-        )
-
     # Run EternaFold
     if n_samples > 1:
         assert n_samples == 100, "EternaFold using subprocess only supports nsamples=100"
         cmd = [
             eternafold_path, 
             "sample",
-            fasta_file_path,
             # f" --nsamples {n_samples}",
             # It seems like EternaFold using subprocess can only sample the default nsamples=100...
             # Reason: unknown for now
@@ -159,14 +278,15 @@ def predict_sec_struct(
         cmd = [
             eternafold_path, 
             "predict",
-            fasta_file_path,
         ]
 
-    output = subprocess.run(cmd, check=True, capture_output=True).stdout.decode("utf-8")
-
-    # Delete temporary files
     if sequence is not None:
-        os.remove(fasta_file_path)
+        assert fasta_file_path is None
+        output = _run_eternafold_on_fasta(
+            cmd, SeqRecord(Seq(sequence), id="temp").format("fasta")
+        )
+    else:
+        output = subprocess.run(cmd + [fasta_file_path], check=True, capture_output=True).stdout.decode("utf-8")
 
     if n_samples > 1:
         return output.split("\n")[:-1]
@@ -174,66 +294,166 @@ def predict_sec_struct(
         return [output.split("\n")[-2]]
 
 
+def predict_sec_struct_batch(
+        sequences: List[str],
+        eternafold_path: str = os.path.join(ETERNAFOLD_PATH, "src/contrafold"),
+    ) -> List[str]:
+    """
+    Predict the MFE secondary structure of several sequences with a single 
+    EternaFold process.
+
+    Notes:
+    - EternaFold only supports single chains in a fasta file, so each sequence
+      is written to its own fasta file and all files are passed to one
+      `contrafold predict` call, which writes one structure per file to an
+      output directory given by `--parens`.
+
+    Args:
+        sequences (List[str]): Sequences of RNA molecules.
+        eternafold_path (str, optional): Path to EternaFold. Defaults to ETERNAFOLD_PATH env variable.
+    
+    Returns:
+        List of secondary structures in dot-bracket notation, one per sequence.
+    """
+    if len(sequences) == 0:
+        return []
+    if len(sequences) == 1:
+        # with a single input file, `--parens` names a file instead of a directory
+        return predict_sec_struct(sequences[0], eternafold_path=eternafold_path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_file_paths = []
+        for i, sequence in enumerate(sequences):
+            fasta_file_path = os.path.join(tmp_dir, f"temp_{i}.fasta")
+            SeqIO.write(
+                SeqRecord(Seq(sequence), id=f"temp_{i}"),
+                fasta_file_path, "fasta"
+            )
+            fasta_file_paths.append(fasta_file_path)
+
+        # Run EternaFold once for all sequences
+        out_dir = os.path.join(tmp_dir, "parens")
+        cmd = [
+            eternafold_path,
+            "predict",
+            *fasta_file_paths,
+            "--parens",
+            out_dir,
+        ]
+        subprocess.run(cmd, check=True, capture_output=True)
+
+        # Last line of each output file is the structure
+        sec_structs = []
+        for fasta_file_path in fasta_file_paths:
+            with open(os.path.join(out_dir, os.path.basename(fasta_file_path))) as f:
+                sec_structs.append(f.read().strip().split("\n")[-1])
+    
+    return sec_structs
+
+
+# Class of each ASCII code in dot-bracket notation: 1 for '(', 2 for ')', else 0
+_BRACKET_LUT = np.zeros(256, dtype=np.uint8)
+_BRACKET_LUT[ord('(')] = 1
+_BRACKET_LUT[ord(')')] = 2
+
+
 def dotbracket_to_paired(sec_struct: str) -> np.ndarray:
     """
     Return whether each residue is paired (1) or unpaired (0) given 
     secondary structure in dot-bracket notation.
     """
-    is_paired = np.zeros(len(sec_struct), dtype=np.int8)
-    for i, c in enumerate(sec_struct):
-        if c == '(' or c == ')':
-            is_paired[i] = 1
+    db = np.frombuffer(sec_struct.encode('ascii'), dtype=np.uint8)
+    is_paired = (_BRACKET_LUT[db] != 0).astype(np.int8)
     return is_paired
 
 
+@numba.njit(cache=True)
+def _dotbracket_pairs(db: np.ndarray):
+    # Single pass over the ASCII codes of a dot-bracket string, matching
+    # '(' and ')' with a preallocated stack; returns COO indices
+    n = db.shape[0]
+    rows = np.empty(n, dtype=np.int32)
+    cols = np.empty(n, dtype=np.int32)
+    stack = np.empty(n, dtype=np.int32)
+    top = 0
+    num = 0
+    for i in range(n):
+        code = _BRACKET_LUT[db[i]]
+        if code == 1:
+            stack[top] = i
+            top += 1
+        elif code == 2:
+            if top == 0:
+                raise ValueError("Unbalanced brackets in dot-bracket notation")
+            top -= 1
+            j = stack[top]
+            rows[num] = i
+            cols[num] = j
+            rows[num + 1] = j
+            cols[num + 1] = i
+            num += 2
+    return rows[:num], cols[:num]
+
+# Compile on import rather than on the first call
+_dotbracket_pairs(np.frombuffer(b"(.)", dtype=np.uint8))
+
+
 def dotbracket_to_num(sec_struct: str) -> np.ndarray:
     """
     Convert secondary structure in dot-bracket notation to 
-    numerical representation.
-    "X3DNA_PATH,""
-    Convert secondary structure in dot-bracket notation to 
-    adjacency matrix.
+    numerical representation, i.e. its adjacency matrix.
     """
-    n = len(sec_struct)
-    adj = np.zeros((n, n), dtype=np.int8)
-    stack = []
-    for i, db_char in enumerate(sec_struct):
-        if db_char == '(':
-            stack.append(i)
-        elif db_char == ')':
-            j = stack.pop()
-            adj[i, j] = 1
-            adj[j, i] = 1
-    return adj
-
-def dotbracket_to_adjacency(sec_struct: str) -> np.ndarray:
+    return dotbracket_to_adjacency(sec_struct)
+
+def dotbracket_to_adjacency(
+        sec_struct: str, 
+        sparse: bool = False
+    ) -> Union[np.ndarray, csr_matrix]:
     """
     Convert secondary structure in dot-bracket notation to 
     adjacency matrix.
+
+    By default, the dense int8 matrix is returned; with `sparse=True`, the
+    matrix is returned in sparse CSR format as it holds at most one entry
+    per row.
     """
+    if sparse:
+        return _dotbracket_to_csr(sec_struct)
+    n = len(sec_struct)
+    rows, cols = _dotbracket_pairs(np.frombuffer(sec_struct.encode('ascii'), dtype=np.uint8))
+    adjacency = np.zeros((n, n), dtype=np.int8)
+    adjacency[rows, cols] = 1
+    return adjacency
+
+def _dotbracket_to_csr(sec_struct: str) -> csr_matrix:
     n = len(sec_struct)
-    adj = np.zeros((n, n), dtype=np.int8)
-    stack = []
-    for i, db_char in enumerate(sec_struct):
-        if db_char == '(':
-            stack.append(i)
-        elif db_char == ')':
-            j = stack.pop()
-            adj[i, j] = 1
-            adj[j, i] = 1
-    return adj
+    rows, cols = _dotbracket_pairs(np.frombuffer(sec_struct.encode('ascii'), dtype=np.uint8))
+    # each residue pairs with at most one other, so the partner of each
+    # row gives the CSR column indices directly
+    partner = np.full(n, -1, dtype=np.int32)
+    partner[rows] = cols
+    is_paired = partner >= 0
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(is_paired, out=indptr[1:])
+    return csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), partner[is_paired], indptr), shape=(n, n)
+    )
+
+def to_dense_int8(adjacency: spmatrix) -> np.ndarray:
+    """
+    Convert a sparse adjacency matrix to a dense int8 matrix.
+    """
+    return adjacency.toarray().astype(np.int8, copy=False)
 
 #=======================MODIFICATIONS===================================================
 def get_unpaired(length, basepairs):
-    unpaired_idx =  [i for i in range(length)]
-    unpaired_idx_original = unpaired_idx.copy()
-    for pair in basepairs:
-        if (abs(pair[1] - pair[0]) != 1):
-            if (pair[0]-1 in unpaired_idx):
-                unpaired_idx.remove(pair[0]-1)
-            if (pair[1]-1 in unpaired_idx):
-                unpaired_idx.remove(pair[1]-1)
-    return unpaired_idx
+    bp = np.asarray(basepairs, dtype=np.int64).reshape(-1, 2)
+    # pairs between consecutive residues do not count as paired
+    bp = bp[np.abs(bp[:, 1] - bp[:, 0]) != 1] - 1
+    idx = bp.ravel()
+    is_unpaired = np.ones(length, dtype=bool)
+    is_unpaired[idx[(idx >= 0) & (idx < length)]] = False
+    return np.nonzero(is_unpaired)[0].tolist()
 
 def pdb_to_sec_struct_bp(
         pdb_file_path: str,
@@ -244,6 +464,7 @@ def pdb_to_sec_struct_bp(
         # x3dna_path: str = os.path.join(X3DNA_PATH, "bin/find_pair"),
         dssr_path: str = DSSR_PATH,
         max_len_for_biotite: int = 1000,
+        use_cache: bool = False,
     ):
     """
     base pairs from a PDB file.
@@ -256,7 +477,19 @@ def pdb_to_sec_struct_bp(
         x3dna_path (str, optional): Path to x3dna find_pair tool.
         max_len_for_biotite (int, optional): Maximum length of sequence for
             which to use biotite. Otherwise use X3DNA Defaults to 1000.
+        use_cache (bool, optional): Whether to look up and store the result 
+            in the on-disk cache entry shared with `pdb_to_sec_struct`, keyed
+            by the contents of the PDB file and all other arguments. 
+            Defaults to False.
     """
+    cache_key = None
+    if use_cache and SEC_STRUCT_CACHE_PATH is not None:
+        cache_key = _sec_struct_cache_key(pdb_file_path)
+        cache_field = ("sec_bp", sequence, _pdb_map_digest(pdb_map), keep_pseudoknots, dssr_path)
+        sec_struct = _read_sec_struct_cache(cache_key, cache_field)
+        if sec_struct is not None:
+            return sec_struct
+
     sec_struct = []
     # fr3d_sec_struct = []
     if 1 < len(sequence) < 4000:
@@ -284,71 +517,58 @@ def pdb_to_sec_struct_bp(
             # does not support pseudoknots
         #    fr3d_sec_struct = []
 
+    if cache_key is not None:
+        _write_sec_struct_cache(cache_key, cache_field, sec_struct)
     return sec_struct #, fr3d_sec_struct
 
 def pdb_to_x3dna_2(
         pdb_file_path: str, 
-        dssr_path: str = os.path.join(DSSR_PATH, "x3dna-dssr")
+        dssr_path: str = DSSR_PATH
     ) -> List[str]:
-    # Run x3dna find_pair tool
+    # Run x3dna-dssr base pair annotation
     cmd = [
-        dssr_path,
-        pdb_file_path,
+        os.path.join(dssr_path, "x3dna-dssr"),
+        "".join(["-i=", os.path.abspath(pdb_file_path)]),
+        "--pair-only"
     ]
-    cmd = [os.path.join(dssr_path, "x3dna-dssr"), "".join(["-i=",pdb_file_path]), "--pair-only"]
-    output = subprocess.run(cmd, check=True, capture_output=True).stdout.decode("utf-8")
+    # x3dna-dssr writes dssr-* scratch files to its working directory,
+    # which are deleted together with the temporary directory
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = subprocess.run(cmd, cwd=tmp_dir, check=True, capture_output=True).stdout.decode("utf-8")
     output = output.split("\n")
-
-    # Delete temporary files
-    dssr_files = glob.glob("./dssr-*")
-    for file in dssr_files:
-        os.remove(file)
-    # os.remove("./dssr-2ndstrs.bpseq")
-
                       
     return output
 
 
+# index, first and second nucleotide of each row of x3dna-dssr --pair-only output
+_PAIR_RE = re.compile(r"^[ \t]*\S+[ \t]+(\S+)[ \t]+(\S+)", re.M)
+
+
 def x3dna_to_sec_struct_2(output: List[str], sequence: str, pdb_map) -> list:
     # Secondary structure as base-pair tuples
     list_bp = []
-    # sec_struct = ["."] * len(sequence)
-    for i in range(4, len(output)-1):
-        line = output[i].split()
-        start_str = line[1][0]+":"+line[1][2]+":"+line[1][3:]+":"
-        end_str = line[2][0]+":"+line[2][2]+":"+line[2][3:]+":"
-        #if start_str.find("^") != -1:
-        #    start_str = start_str[:start_str.index("^")]
-        #if end_str.find("^") != -1:
-        #    end_str = end_str[:end_str.index("^")]
-        #start_abs, end_abs = int(start_str), int(end_str)
-
-        start = pdb_map.get(start_str,0)
-        end = pdb_map.get(end_str,0)
+    get_residue, append = pdb_map.get, list_bp.append
+    # nucleotides are given as e.g. A.G12, residues as ("A", "G", "12", "")
+    for start_nt, end_nt in _PAIR_RE.findall("\n".join(output[4:-1])):
+        start = get_residue((start_nt[0], start_nt[2], start_nt[3:], ""), 0)
+        end = get_residue((end_nt[0], end_nt[2], end_nt[3:], ""), 0)
         if (start < end) and (start != 0) and (end != 0):
-            list_bp.append([start,end])
+            append([start,end])
 
     return list_bp
 
 def fr3d_to_sec_struct(fr3d_file_path, sequence, pdb_map):
     list_bp = []
-    try:
-        f = open(fr3d_file_path, "r")
-        for line in f.readlines():
-            line_split = line.split("\t")
-            start_id = line_split[0].split("|")[2]+":"+line_split[0].split("|")[3]+":"+line_split[0].split("|")[4]+":"
-            end_id = line_split[2].split("|")[2]+":"+line_split[2].split("|")[3]+":"+line_split[2].split("|")[4]+":"
-            start = pdb_map.get(start_id,0)
-            end = pdb_map.get(end_id,0)
+    get_residue, append = pdb_map.get, list_bp.append
+    with open(fr3d_file_path, "r", newline="") as f:
+        # rows are <nt1> <interaction> <nt2> ..., with nucleotides given as
+        # e.g. 1ABC|1|A|G|12 and residues as ("A", "G", "12", "")
+        for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+            start_chain, start_res, start_num = row[0].split("|")[2:5]
+            end_chain, end_res, end_num = row[2].split("|")[2:5]
+            start = get_residue((start_chain, start_res, start_num, ""), 0)
+            end = get_residue((end_chain, end_res, end_num, ""), 0)
             if (start < end) and (start != 0) and (end != 0):
-                list_bp.append([start, end])
-        f.close()
-        
-    except Exception as e:
-        # biotite fails for very short seqeunces
-        if "out of bounds for array" not in str(e): raise e
-        # get secondary structure using x3dna find_pair tool
-        # does not support pseudoknots
-        list_bp = []
-        
+                append([start, end])
+
     return list_bp
\ No newline at end of file
@@ -27,6 +27,7 @@ from MDAnalysis.analysis.rms import rmsd as get_rmsd
 from src.data.data_utils import get_c4p_coords
 from src.data.sec_struct_utils import (
     predict_sec_struct,
+    predict_sec_struct_batch,
     dotbracket_to_paired,
     dotbracket_to_adjacency
 )
@@ -339,11 +340,17 @@ def self_consistency_score_eternafold(
 
     mcc_scores = []
     pred_sec_structs = []
-    for _sample in samples:
-        # convert sample to string
-        pred_seq = ''.join([num_to_letter[num] for num in _sample])
+    # convert samples to strings
+    pred_seqs = [''.join([num_to_letter[num] for num in _sample]) for _sample in samples]
+    if n_samples_ss == 1:
+        # predict MFE structures for all samples in a single EternaFold run
+        batch_sec_structs = predict_sec_struct_batch(pred_seqs)
+    for i, pred_seq in enumerate(pred_seqs):
         # predict secondary structure(s) for each sample
-        pred_sec_struct_list = predict_sec_struct(pred_seq, n_samples=n_samples_ss)
+        if n_samples_ss == 1:
+            pred_sec_struct_list = [batch_sec_structs[i]]
+        else:
+            pred_sec_struct_list = predict_sec_struct(pred_seq, n_samples=n_samples_ss)
         if return_sec_structs:
             pred_sec_structs.append(copy.copy(pred_sec_struct_list))
         # map all entries from dotbracket to numerical representation